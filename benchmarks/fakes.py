@@ -0,0 +1,469 @@
+# Lightweight stand-ins for the Klipper objects used by the extensions.
+#
+# The objects below implement only the parts of the Klipper interfaces
+# which the extensions call. They allow the extensions to be loaded and
+# exercised without a printer or a Klipper installation.
+#
+# Copyright (C) 2023 Mitko Haralanov <voidtrance@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os
+import sys
+import time
+import types
+import select
+import importlib.util
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+
+class FakeReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.now = 1000.
+        self.timers = []
+        self.fds = {}
+
+    def monotonic(self):
+        if self.realtime:
+            return time.monotonic()
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = FakeTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+
+    def unregister_timer(self, timer):
+        timer.waketime = self.NEVER
+        self.timers.remove(timer)
+
+    def register_callback(self, callback, waketime=NOW):
+        def _callback(eventtime):
+            callback(eventtime)
+            return self.NEVER
+        return self.register_timer(_callback, waketime)
+
+    def register_fd(self, fd, callback):
+        self.fds[fd] = callback
+        return fd
+
+    def unregister_fd(self, hdl):
+        self.fds.pop(hdl, None)
+
+    def _poll_fds(self, timeout):
+        if not self.fds:
+            if timeout > 0.:
+                time.sleep(timeout)
+            return
+        ready, _, _ = select.select(list(self.fds), [], [], max(timeout, 0.))
+        for fd in ready:
+            if fd in self.fds:
+                self.fds[fd](self.monotonic())
+
+    def pause(self, waketime):
+        if not self.realtime:
+            self.now = max(self.now, waketime)
+            return self.now
+        now = time.monotonic()
+        while now < waketime:
+            self._poll_fds(waketime - now)
+            now = time.monotonic()
+        return now
+
+    # Dispatch all timers scheduled up to 'endtime' in order, advancing the
+    # virtual clock to each timer's wake time.
+    def run(self, endtime):
+        while True:
+            timer = min(self.timers, key=lambda t: t.waketime, default=None)
+            if timer is None or timer.waketime > endtime:
+                break
+            self.now = max(self.now, timer.waketime)
+            timer.waketime = self.NEVER
+            waketime = timer.callback(self.now)
+            if timer in self.timers:
+                timer.waketime = waketime
+        self.now = max(self.now, endtime)
+
+    def advance(self, duration):
+        self.run(self.now + duration)
+
+
+class FakeMutex:
+    def __init__(self):
+        self.locked = False
+
+    def test(self):
+        return self.locked
+
+    def __enter__(self):
+        self.locked = True
+
+    def __exit__(self, type=None, value=None, tb=None):
+        self.locked = False
+
+
+class FakeGCodeCommand:
+    def __init__(self, command, params):
+        self._command = command
+        self._params = dict(params)
+        self._commandline = " ".join([command] + ["%s=%s" % (k, v) for k, v in
+                                                  self._params.items()])
+
+    def get_command_parameters(self):
+        return dict(self._params)
+
+    def get_raw_command_parameters(self):
+        return self._commandline[len(self._command):].strip()
+
+    def get(self, name, default=None):
+        return self._params.get(name, default)
+
+    def _get_number(self, name, default, parser, minval=None, maxval=None):
+        value = self._params.get(name)
+        if value is None:
+            return default
+        value = parser(value)
+        if minval is not None:
+            value = max(value, minval)
+        if maxval is not None:
+            value = min(value, maxval)
+        return value
+
+    def get_int(self, name, default=None, minval=None, maxval=None):
+        return self._get_number(name, default, int, minval, maxval)
+
+    def get_float(self, name, default=None, minval=None, maxval=None,
+                  above=None, below=None):
+        return self._get_number(name, default, float, minval, maxval)
+
+    def error(self, msg):
+        return Exception(msg)
+
+
+class FakeGCode:
+    error = Exception
+
+    def __init__(self):
+        self.mutex = FakeMutex()
+        self.commands = {}
+        self.scripts = 0
+        self.responses = 0
+
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        self.commands[(cmd, value)] = func
+
+    def get_mutex(self):
+        return self.mutex
+
+    def run_script(self, script):
+        self.scripts += 1
+
+    def run_script_from_command(self, script):
+        self.scripts += 1
+
+    def respond_info(self, msg, log=True):
+        self.responses += 1
+
+    def create_gcode_command(self, command, commandline, params):
+        return FakeGCodeCommand(command, params)
+
+
+# Templates are rendered with jinja2, the same way Klipper renders them,
+# when it is available. Otherwise, the template script is used as is.
+def create_template_env():
+    if jinja2 is None:
+        return None
+    return jinja2.Environment('{%', '%}', '{', '}')
+
+
+class FakeTemplate:
+    def __init__(self, printer, script, env=None):
+        self.printer = printer
+        self.script = script
+        self.template = None
+        if env is None:
+            env = printer.lookup_object("gcode_macro").env
+        if env is not None and script:
+            self.template = env.from_string(script)
+
+    def __bool__(self):
+        return bool(self.script)
+
+    def create_template_context(self, eventtime=None):
+        return {'printer': {}}
+
+    def render(self, context=None):
+        if self.template is None:
+            return self.script
+        if context is None:
+            context = self.create_template_context()
+        return str(self.template.render(context))
+
+    def run_gcode_from_command(self, context=None):
+        self.printer.lookup_object("gcode").run_script_from_command(
+            self.render(context))
+
+
+class FakeTemplateWrapper(FakeTemplate):
+    def __init__(self, printer, env, name, script):
+        FakeTemplate.__init__(self, printer, script, env)
+
+
+class FakeGCodeMacroModule:
+    def __init__(self, printer):
+        self.printer = printer
+        self.env = create_template_env()
+
+    def load_template(self, config, option, default=None):
+        return FakeTemplate(self.printer, config.get(option, default),
+                            self.env)
+
+
+class FakeGCodeMacro:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.alias = config.get_name().split()[-1].upper()
+        macro_obj = self.printer.load_object(config, 'gcode_macro')
+        self.template = macro_obj.load_template(config, 'gcode')
+        self.variables = {}
+
+
+class FakeLedHelper:
+    def __init__(self, led_count):
+        self.led_count = led_count
+        self.led_state = [(0., 0., 0., 0.)] * led_count
+        self.transmits = 0
+
+    def _set_color(self, index, color):
+        self.led_state[index] = color
+
+    def _check_transmit(self, print_time=None):
+        self.transmits += 1
+
+
+class FakeLed:
+    def __init__(self, led_count):
+        self.led_helper = FakeLedHelper(led_count)
+
+    def get_status(self, eventtime=None):
+        return {"color_data": [list(c) for c in self.led_helper.led_state]}
+
+
+class FakeTempSensor:
+    def __init__(self, temps):
+        self.temps = temps
+        self.index = 0
+
+    def get_temp(self, eventtime):
+        temp = self.temps[self.index % len(self.temps)]
+        self.index += 1
+        return temp, 0.
+
+
+class FakeHeater:
+    def __init__(self):
+        self.target_temp = 0.
+
+    def set_temp(self, degrees):
+        self.target_temp = degrees
+
+    def get_status(self, eventtime):
+        return {"temperature": 25., "target": self.target_temp, "power": 0.}
+
+
+# Like Klipper, the list of available heaters contains the full config
+# section names while heaters are looked up by the last part of the name.
+class FakeHeaters:
+    def __init__(self, names):
+        self.available_heaters = list(names)
+        self.heaters = {name.split()[-1]: FakeHeater() for name in names}
+
+    def get_all_heaters(self):
+        return self.available_heaters
+
+    def lookup_heater(self, name):
+        if name not in self.heaters:
+            raise Exception("Unknown heater '%s'" % name)
+        return self.heaters[name]
+
+
+class FakeIdleTimeout:
+    def __init__(self, timeout=600.):
+        self.state = "Ready"
+        self.idle_timeout = timeout
+        self.idle_gcode = None
+
+    def check_idle_timeout(self, eventtime):
+        return eventtime + self.idle_timeout
+
+
+class FakeVirtualSD:
+    def is_active(self):
+        return False
+
+    def file_path(self):
+        return None
+
+    def progress(self):
+        return 0.
+
+
+class FakePrintStats:
+    def get_status(self, eventtime):
+        return {"state": "standby"}
+
+
+class FakeConfigFile:
+    def get_status(self, eventtime):
+        return {"config": {}}
+
+
+class FakePrinter:
+    def __init__(self, reactor=None):
+        self.reactor = reactor or FakeReactor()
+        self.objects = {}
+        self.event_handlers = {}
+        self.shutdown = False
+        self.objects["gcode"] = FakeGCode()
+        self.objects["gcode_macro"] = FakeGCodeMacroModule(self)
+        self.objects["configfile"] = FakeConfigFile()
+
+    def get_reactor(self):
+        return self.reactor
+
+    def is_shutdown(self):
+        return self.shutdown
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def lookup_object(self, name, default=Exception):
+        if name in self.objects:
+            return self.objects[name]
+        if default is Exception:
+            raise Exception("Unknown object '%s'" % name)
+        return default
+
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        prefix = module + ' '
+        return [(name, obj) for name, obj in self.objects.items()
+                if name.startswith(prefix) or name == module]
+
+    # Objects from this repository (i.e. 'extensions_profile') are loaded
+    # the same way Klipper would load them.
+    def load_object(self, config, section, default=Exception):
+        if section not in self.objects and \
+                os.path.exists(os.path.join(SRCDIR, section, section + ".py")):
+            module = load_extension(section)
+            self.objects[section] = module.load_config(
+                FakeConfig(self, section))
+        return self.lookup_object(section, default)
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+
+
+class FakeConfigError(Exception):
+    pass
+
+
+class FakeConfig:
+    error = FakeConfigError
+
+    def __init__(self, printer, name, options=None):
+        self.printer = printer
+        self.name = name
+        self.options = dict(options or {})
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get(self, option, default=Exception):
+        if option in self.options:
+            return self.options[option]
+        if default is Exception:
+            raise self.error("Option '%s' in section '%s' must be specified" %
+                             (option, self.name))
+        return default
+
+    def _get_typed(self, option, default, parser):
+        value = self.get(option, default)
+        return parser(value) if value is not None else value
+
+    def getint(self, option, default=Exception, minval=None, maxval=None):
+        return self._get_typed(option, default, int)
+
+    def getfloat(self, option, default=Exception, minval=None, maxval=None,
+                 above=None, below=None):
+        return self._get_typed(option, default, float)
+
+    # Option values may be given as strings, as they would appear in a
+    # configuration file, or as Python values.
+    def getboolean(self, option, default=Exception):
+        def parse(value):
+            if isinstance(value, str):
+                return value.strip().lower() in ("1", "true", "yes", "on")
+            return bool(value)
+        return self._get_typed(option, default, parse)
+
+    def getchoice(self, option, choices, default=Exception):
+        return choices[self.get(option, default)]
+
+    def get_prefix_options(self, prefix):
+        return [o for o in self.options if o.startswith(prefix)]
+
+
+# The extensions import Klipper's 'extras.gcode_macro' module. Provide a
+# stand-in module so they can be imported outside of Klipper.
+def install_klipper_modules():
+    if "extras" in sys.modules:
+        return
+    extras = types.ModuleType("extras")
+    extras.__path__ = []
+    gcode_macro = types.ModuleType("extras.gcode_macro")
+    gcode_macro.TemplateWrapper = FakeTemplateWrapper
+    gcode_macro.GCodeMacro = FakeGCodeMacro
+    extras.gcode_macro = gcode_macro
+    sys.modules["extras"] = extras
+    sys.modules["extras.gcode_macro"] = gcode_macro
+
+
+def load_extension(name):
+    install_klipper_modules()
+    modname = "extras." + name
+    if modname in sys.modules:
+        return sys.modules[modname]
+    path = os.path.join(SRCDIR, name, name + ".py")
+    spec = importlib.util.spec_from_file_location(modname, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[modname] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# Offline benchmarks for the extensions.
+#
+# Each benchmark loads an extension against the stand-in printer objects
+# from fakes.py and drives a repeatable workload through it. Throughput,
+# latency percentiles, and memory allocations are reported for each one.
+#
+# Copyright (C) 2023 Mitko Haralanov <voidtrance@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import logging
+import tracemalloc
+
+import fakes
+
+
+class Benchmark:
+    def __init__(self, name, setup, count, desc):
+        self.name = name
+        self.setup = setup
+        self.count = count
+        self.desc = desc
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.
+    index = min(int(len(samples) * pct / 100.), len(samples) - 1)
+    return samples[index]
+
+
+# Each setup function prepares the extension and returns a callable, which
+# runs a single operation of the workload.
+
+def setup_temp_tracker(scale):
+    temp_tracker = fakes.load_extension("temp_tracker")
+    printer = fakes.FakePrinter()
+    printer.add_object("temperature_sensor chamber",
+                       fakes.FakeTempSensor([40. + (i % 50) / 10.
+                                             for i in range(997)]))
+    config = fakes.FakeConfig(printer, "temp_tracker chamber",
+                              {"sensor": "chamber", "period": 3600,
+                               "range_min": 10., "range_max": 80.})
+    tracker = temp_tracker.load_config_prefix(config)
+    printer.send_event("klippy:ready")
+    reactor = printer.get_reactor()
+    # Fill the tracking window so the workload measures steady state.
+    for i in range(tracker.period):
+        tracker.tracker_track(reactor.monotonic() + i)
+
+    def op(i):
+        tracker.tracker_track(reactor.monotonic() + i)
+    return op
+
+
+def setup_led_interpolate(scale):
+    led_interpolate = fakes.load_extension("led_interpolate")
+    printer = fakes.FakePrinter()
+    printer.add_object("neopixel chain", fakes.FakeLed(300))
+    config = fakes.FakeConfig(printer, "led_interpolate")
+    leds = led_interpolate.load_config(config)
+    printer.send_event("klippy:ready")
+    reactor = printer.get_reactor()
+    gcode = printer.lookup_object("gcode")
+    colors = [{"RED": 1., "GREEN": .5, "BLUE": .25, "WHITE": 0.},
+              {"RED": 0., "GREEN": .25, "BLUE": .5, "WHITE": 1.}]
+
+    def op(i):
+        # Start a new transition every 24 frames (one second).
+        if i % led_interpolate.FRAME_COUNT == 0:
+            params = dict(colors[(i // led_interpolate.FRAME_COUNT) % 2])
+            params.update({"LED": "chain", "DURATION": 1.})
+            leds.cmd_LED_INTERPOLATE(
+                gcode.create_gcode_command("LED_INTERPOLATE", "", params))
+            reactor.unregister_timer(leds.timer)
+        reactor.now += led_interpolate.INTERPOLATE_STEP_TIME
+        leds.interpolate_leds(reactor.monotonic())
+    return op
+
+
+def setup_loop_macro(scale):
+    loop_macro = fakes.load_extension("loop_macro")
+    printer = fakes.FakePrinter()
+    config = fakes.FakeConfig(printer, "loop_macro bench",
+                              {"gcode": "G0 X{iter}\nG0 Y{iter}\nM400",
+                               "entry": "G28", "exit": "M84"})
+    macro = loop_macro.load_config_prefix(config)
+    gcode = printer.lookup_object("gcode")
+    # LIMIT=0 means no limit so always run at least one iteration.
+    iterations = max(10000 // scale, 1)
+
+    def op(i):
+        macro.cmd(gcode.create_gcode_command("BENCH", "",
+                                             {"LIMIT": iterations}))
+    return op
+
+
+def setup_shell_spawn(scale):
+    gcode_shell_command = fakes.load_extension("gcode_shell_command")
+    printer = fakes.FakePrinter(fakes.FakeReactor(realtime=True))
+    config = fakes.FakeConfig(printer, "gcode_shell_command bench",
+                              {"command": "printf 'VALUE_UPDATE:count=1\\n'",
+                               "timeout": 2., "value_count": "0"})
+    cmd = gcode_shell_command.load_config_prefix(config)
+    gcode = printer.lookup_object("gcode")
+
+    def op(i):
+        cmd.cmd_RUN_SHELL_COMMAND(
+            gcode.create_gcode_command("RUN_SHELL_COMMAND", "", {}))
+    return op
+
+
+def setup_shell_output(scale):
+    gcode_shell_command = fakes.load_extension("gcode_shell_command")
+    printer = fakes.FakePrinter()
+    config = fakes.FakeConfig(printer, "gcode_shell_command bench",
+                              {"command": "true", "value_temp": "0",
+                               "value_count": "0"})
+    cmd = gcode_shell_command.load_config_prefix(config)
+    rfd, wfd = os.pipe()
+    cmd.proc_fd = rfd
+    lines = ["VALUE_UPDATE:temp=%d\nplain output line %d\n" % (i, i)
+             for i in range(64)]
+    # Split some of the chunks mid-line to exercise the partial output
+    # handling.
+    chunks = [(l[:20].encode(), l[20:].encode()) for l in lines]
+
+    def op(i):
+        for chunk in chunks[i % len(chunks)]:
+            os.write(wfd, chunk)
+            cmd._process_output(0.)
+    return op
+
+
+def setup_state_notify(scale):
+    state_notify = fakes.load_extension("state_notify")
+    printer = fakes.FakePrinter()
+    reactor = printer.get_reactor()
+    printer.add_object("idle_timeout", fakes.FakeIdleTimeout())
+    printer.add_object("virtual_sdcard", fakes.FakeVirtualSD())
+    printer.add_object("print_stats", fakes.FakePrintStats())
+    heaters = fakes.FakeHeaters(["extruder", "heater_bed",
+                                 "heater_generic chamber"])
+    printer.add_object("heaters", heaters)
+    config = fakes.FakeConfig(printer, "state_notify",
+                              {"inactive_timeout": 30.,
+                               "on_ready_gcode": "M117 ready",
+                               "on_active_gcode": "M117 active",
+                               "on_inactive_gcode": "M117 inactive"})
+    notify = state_notify.load_config(config)
+    printer.send_event("klippy:mcu_identify")
+    printer.send_event("klippy:ready")
+    reactor.advance(0.)
+    mutex = printer.lookup_object("gcode").get_mutex()
+    extruder = heaters.lookup_heater("extruder")
+
+    def op(i):
+        # Hold the gcode mutex on every other cycle so templates go through
+        # the deferred dispatch path.
+        mutex.locked = bool(i % 2)
+        printer.send_event("idle_timeout:printing", reactor.monotonic())
+        extruder.set_temp(200.)
+        printer.send_event("idle_timeout:ready", reactor.monotonic())
+        reactor.advance(notify.inactive_timeout)
+        extruder.set_temp(0.)
+        mutex.locked = False
+        reactor.advance(notify.inactive_timeout)
+    return op
+
+
+BENCHMARKS = [
+    Benchmark("temp_tracker", setup_temp_tracker, 100000,
+              "TempTracker.tracker_track() with a 3600s window"),
+    Benchmark("led_interpolate", setup_led_interpolate, 2400,
+              "LedInterpolate.interpolate_leds() frame on 300 LEDs"),
+    Benchmark("loop_macro", setup_loop_macro, 5,
+              "LoopMacro.cmd() running 10000 iterations"),
+    Benchmark("shell_spawn", setup_shell_spawn, 50,
+              "ShellCommand.cmd_RUN_SHELL_COMMAND() process spawn"),
+    Benchmark("shell_output", setup_shell_output, 20000,
+              "ShellCommand._process_output() output parsing"),
+    Benchmark("state_notify", setup_state_notify, 20000,
+              "StateNotify active/inactive cycle with timer churn"),
+]
+
+
+def run_benchmark(bench, scale):
+    count = max(bench.count // scale, 1)
+    # Timing pass.
+    op = bench.setup(scale)
+    samples = []
+    gc.collect()
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        op(i)
+        samples.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    samples.sort()
+    # Allocation pass. This is done separately since tracing allocations
+    # slows down execution.
+    op = bench.setup(scale)
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        op(i)
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(s.count_diff for s in stats if s.count_diff > 0)
+    return {"name": bench.name,
+            "description": bench.desc,
+            "operations": count,
+            "ops_per_sec": count / total if total else 0.,
+            "latency_usec": {"p50": percentile(samples, 50) * 1e6,
+                             "p90": percentile(samples, 90) * 1e6,
+                             "p99": percentile(samples, 99) * 1e6,
+                             "max": samples[-1] * 1e6},
+            "memory": {"peak_kib": (peak - base) / 1024.,
+                       "retained_kib": (current - base) / 1024.,
+                       "retained_blocks": blocks}}
+
+
+def print_results(results):
+    header = "%-16s %10s %12s %10s %10s %10s %10s %10s %10s" % \
+        ("benchmark", "ops", "ops/s", "p50 us", "p90 us", "p99 us",
+         "max us", "peak KiB", "kept KiB")
+    print(header)
+    print("-" * len(header))
+    for res in results:
+        lat = res["latency_usec"]
+        mem = res["memory"]
+        print("%-16s %10d %12.1f %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f" %
+              (res["name"], res["operations"], res["ops_per_sec"],
+               lat["p50"], lat["p90"], lat["p99"], lat["max"],
+               mem["peak_kib"], mem["retained_kib"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run extension benchmarks")
+    parser.add_argument("-k", "--select", action="append", default=[],
+                        help="Run only the named benchmark(s)")
+    parser.add_argument("-s", "--scale", type=int, default=1,
+                        help="Divide the workload sizes by this factor")
+    parser.add_argument("-j", "--json", action="store_true",
+                        help="Output results in JSON format")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="List the available benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        for bench in BENCHMARKS:
+            print("%-16s %s" % (bench.name, bench.desc))
+        return 0
+
+    if fakes.jinja2 is None:
+        sys.stderr.write("jinja2 is not available, templates are not rendered\n")
+
+    # The extensions log through the 'logging' module. Silence it so
+    # logging does not dominate the measurements.
+    logging.disable(logging.CRITICAL)
+    names = [b.name for b in BENCHMARKS]
+    for name in args.select:
+        if name not in names:
+            parser.error("Unknown benchmark '%s'" % name)
+    selected = [b for b in BENCHMARKS
+                if not args.select or b.name in args.select]
+    results = [run_benchmark(b, max(args.scale, 1)) for b in selected]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# Reactor load profiling for the extensions.
+#
+# The extensions register their reactor timers and file descriptor
+# callbacks through this module. Each callback invocation is counted and
+# timed so it is possible to tell how much of the reactor's time is being
+# used by each of them and how late their timers are firing.
+#
+# Copyright (C) 2023 Mitko Haralanov <voidtrance@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections
+
+SAMPLE_COUNT = 256
+
+
+# 'samples' must be sorted.
+def percentile(samples, pct):
+    if not samples:
+        return 0.
+    return samples[min(int(len(samples) * pct / 100.), len(samples) - 1)]
+
+
+class CallbackProfile:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.wakeups = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.max_lag = 0.
+        self.durations = collections.deque(maxlen=SAMPLE_COUNT)
+        self.lags = collections.deque(maxlen=SAMPLE_COUNT)
+        self.status = None
+
+    # The status is only recomputed after the callback has been called
+    # again since front-ends query it much more often than most of the
+    # callbacks run.
+    def get_status(self):
+        if self.status is None:
+            durations = sorted(self.durations)
+            lags = sorted(self.lags)
+            self.status = {'wakeups': self.wakeups,
+                           'total_time': self.total_time,
+                           'time_p50': percentile(durations, 50),
+                           'time_p90': percentile(durations, 90),
+                           'time_p99': percentile(durations, 99),
+                           'time_max': self.max_time,
+                           'lag_p50': percentile(lags, 50),
+                           'lag_p90': percentile(lags, 90),
+                           'lag_p99': percentile(lags, 99),
+                           'lag_max': self.max_lag,
+                           }
+        return self.status
+
+
+# Callable registered with the reactor in place of the extension's
+# callback. It keeps the time at which the timer is expected to fire in
+# order to compute how late it actually fired.
+class ProfiledCallback:
+    def __init__(self, profiler, profile, callback):
+        self.reactor = profiler.reactor
+        self.profile = profile
+        self.callback = callback
+        self.waketime = None
+        self.excluded = 0.
+
+    def set_waketime(self, waketime):
+        if waketime is None or waketime >= self.reactor.NEVER:
+            self.waketime = None
+        elif waketime <= self.reactor.NOW:
+            self.waketime = self.reactor.monotonic()
+        else:
+            self.waketime = waketime
+
+    def __call__(self, eventtime):
+        profile = self.profile
+        start = self.reactor.monotonic()
+        if self.waketime is not None:
+            lag = max(start - self.waketime, 0.)
+            profile.lags.append(lag)
+            if lag > profile.max_lag:
+                profile.max_lag = lag
+        self.excluded = 0.
+        ret = self.callback(eventtime)
+        duration = self.reactor.monotonic() - start - self.excluded
+        profile.wakeups += 1
+        profile.total_time += duration
+        profile.durations.append(duration)
+        if duration > profile.max_time:
+            profile.max_time = duration
+        profile.status = None
+        self.set_waketime(ret)
+        return ret
+
+
+class ExtensionsProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.enabled = config.getboolean("enable", True)
+        self.profiles = {}
+        self.gcode = self.printer.lookup_object("gcode")
+        self.gcode.register_command("EXTENSIONS_PROFILE",
+                                    self.cmd_EXTENSIONS_PROFILE, True,
+                                    desc=self.cmd_EXTENSIONS_PROFILE_help)
+
+    def _wrap(self, name, callback):
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = CallbackProfile(name)
+        return ProfiledCallback(self, profile, callback)
+
+    def register_timer(self, name, callback, waketime=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        if not self.enabled:
+            return self.reactor.register_timer(callback, waketime)
+        wrapper = self._wrap(name, callback)
+        wrapper.set_waketime(waketime)
+        return self.reactor.register_timer(wrapper, waketime)
+
+    # Timers registered through the profiler should be updated through it
+    # as well so the firing lag is computed against the correct time.
+    def update_timer(self, timer, waketime):
+        if isinstance(timer.callback, ProfiledCallback):
+            timer.callback.set_waketime(waketime)
+        self.reactor.update_timer(timer, waketime)
+
+    # Callbacks which pause (i.e. waiting on the gcode mutex) let the reactor
+    # run other callbacks in the meantime. Such waits are reported through
+    # this method so they are not counted as the callback's execution time.
+    def exclude_time(self, timer, duration):
+        if isinstance(timer.callback, ProfiledCallback):
+            timer.callback.excluded += duration
+
+    def register_fd(self, name, fd, callback):
+        if not self.enabled:
+            return self.reactor.register_fd(fd, callback)
+        return self.reactor.register_fd(fd, self._wrap(name, callback))
+
+    def get_status(self, eventtime):
+        return {'enabled': self.enabled,
+                'callbacks': {name: profile.get_status()
+                              for name, profile in self.profiles.items()},
+                }
+
+    cmd_EXTENSIONS_PROFILE_help = "Show extension reactor callback profiles"
+
+    def cmd_EXTENSIONS_PROFILE(self, gcmd):
+        if not self.enabled:
+            gcmd.respond_info("Extension profiling is disabled")
+            return
+        if gcmd.get_int("RESET", 0, minval=0, maxval=1):
+            for profile in self.profiles.values():
+                profile.reset()
+            gcmd.respond_info("Extension profiles reset")
+            return
+        msg = ["%-32s %8s %8s %8s %8s %8s %8s %8s %8s %8s" %
+               ("callback", "wakeups", "p50 ms", "p90 ms", "p99 ms", "max ms",
+                "lag p50", "lag p90", "lag p99", "lag max")]
+        for name, profile in sorted(self.profiles.items()):
+            status = profile.get_status()
+            times = [status[k] * 1000. for k in
+                     ("time_p50", "time_p90", "time_p99", "time_max",
+                      "lag_p50", "lag_p90", "lag_p99", "lag_max")]
+            msg.append("%-32s %8d %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f" %
+                       tuple([name, status["wakeups"]] + times))
+        gcmd.respond_info("\n".join(msg))
+
+
+def load_config(config):
+    return ExtensionsProfile(config)
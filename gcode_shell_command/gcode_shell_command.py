@@ -17,6 +17,8 @@ class ShellCommand:
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
+        self.profiler = self.printer.load_object(config, 'extensions_profile',
+                                                 None)
         cmd = config.get('command')
         cmd = os.path.expanduser(cmd)
         self.command = shlex.split(cmd)
@@ -87,7 +89,11 @@ class ShellCommand:
                 "shell_command: Command {%s} failed" % (self.name))
             raise self.gcode.error("Error running command {%s}" % (self.name))
         self.proc_fd = proc.stdout.fileno()
-        hdl = reactor.register_fd(self.proc_fd, self._process_output)
+        if self.profiler is None:
+            hdl = reactor.register_fd(self.proc_fd, self._process_output)
+        else:
+            hdl = self.profiler.register_fd("gcode_shell_command " + self.name,
+                                            self.proc_fd, self._process_output)
         if self.verbose:
             self.gcode.respond_info("Running Command {%s}...:" % (self.name))
         eventtime = reactor.monotonic()
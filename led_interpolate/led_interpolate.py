@@ -12,6 +12,8 @@ class LedInterpolate:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
+        self.profiler = self.printer.load_object(config, 'extensions_profile',
+                                                 None)
         self.gcode.register_command("LED_INTERPOLATE",
                                     self.cmd_LED_INTERPOLATE, False,
                                     desc=self.cmd_LED_INTERPOLATE_help)
@@ -92,8 +94,13 @@ class LedInterpolate:
         self.step = 0
         reactor = self.printer.get_reactor()
         self.timestep = reactor.monotonic()
-        self.timer = reactor.register_timer(self.interpolate_leds,
-                                            reactor.NOW)
+        if self.profiler is None:
+            self.timer = reactor.register_timer(self.interpolate_leds,
+                                                reactor.NOW)
+        else:
+            self.timer = self.profiler.register_timer("led_interpolate",
+                                                      self.interpolate_leds,
+                                                      reactor.NOW)
 
 def load_config(config):
     return LedInterpolate(config)
@@ -11,25 +11,50 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
+import collections
 from extras.gcode_macro import TemplateWrapper
 
 TIMER_DURATION = 0.1
-GCODE_MUTEX_DELAY = 0.2
 
 
 def log(eventtime, fmt, *args):
     logging.info("state_notify[%s]: " % eventtime + fmt % args)
 
 
+# Stand-in for the 'extensions_profile' module, used when it is not
+# installed. Callbacks are registered with the reactor directly.
+class NoProfiler:
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def register_timer(self, name, callback, waketime=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        return self.reactor.register_timer(callback, waketime)
+
+    def update_timer(self, timer, waketime):
+        self.reactor.update_timer(timer, waketime)
+
+    def exclude_time(self, timer, duration):
+        pass
+
+
 class StateNotify:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.inactive_timeout = config.getfloat("inactive_timeout", 0.)
         self.heaters_keep_active = config.getboolean("heaters_active", False)
+        self.keepalive = config.getchoice("keepalive", {"direct": "direct",
+                                                        "gcode": "gcode"},
+                                          "direct")
+        self.history = collections.deque(maxlen=config.getint("history_size", 20,
+                                                              minval=1))
         self.reactor = self.printer.get_reactor()
         self.gcode = self.printer.lookup_object("gcode")
         self.gcode_macro = self.printer.load_object(config, "gcode_macro")
         self.idle_timeout = self.printer.load_object(config, "idle_timeout")
+        self.profiler = self.printer.load_object(config, "extensions_profile",
+                                                 None) or NoProfiler(self.reactor)
         self.idle_gcode = config.get("on_idle_gcode", '')
         self.gcode_templates = {
             'ready': self.gcode_macro.load_template(config, "on_ready_gcode", ''),
@@ -40,11 +65,21 @@ class StateNotify:
         }
         self.ignore_change = False
         self.state = "none"
+        self.state_start = None
+        self.state_time = {}
+        self.history_status = []
+        self.active_heaters = set()
+        self.keepalive_time = 0.
+        self.template_queue = collections.deque()
+        self.dispatching = False
         self.menu = self.sdcard = self.print_stats = None
-        self.menu_check_timer = self.inactive_timer = self.delayed_gcode_timer = \
+        self.menu_check_timer = self.inactive_timer = self.dispatch_timer = \
             self.pause_timer = None
         self.gcode.register_command("STATE_NOTIFY_STATE", self.cmd_STATE_NOTIFY_STATE,
                                     False, desc=self.cmd_STATE_NOTIFY_STATE_help)
+        self.gcode.register_command("STATE_NOTIFY_HISTORY",
+                                    self.cmd_STATE_NOTIFY_HISTORY, False,
+                                    desc=self.cmd_STATE_NOTIFY_HISTORY_help)
         self.printer.register_event_handler("klippy:mcu_identify",
                                             self._register_ready_handler)
         self.printer.register_event_handler("klippy:shutdown",
@@ -63,6 +98,19 @@ class StateNotify:
         self.pheaters = self.printer.lookup_object("heaters")
         self.menu = self.printer.lookup_object("menu", None)
 
+        # Track heater targets as they are set instead of polling all heaters
+        # each time the inactive timer fires.
+        eventtime = self.reactor.monotonic()
+        # The list of heaters contains the full config section names (i.e.
+        # "heater_generic chamber") but heaters are looked up by the last
+        # part of the name.
+        for heater_name in self.pheaters.get_all_heaters():
+            heater_name = heater_name.split()[-1]
+            heater = self.pheaters.lookup_heater(heater_name)
+            if heater.get_status(eventtime)["target"] > 0.:
+                self.active_heaters.add(heater_name)
+            self._wrap_heater(heater_name, heater)
+
         # Any "idle" gcode specified in the 'state_notife:on_idle_gcode' config
         # needs to be executed as part of the 'idle_timeout:gcode' config. Otherwise,
         # the printer jumps out of "idle" state because the 'state_notify:on_idle_gcode'
@@ -74,10 +122,31 @@ class StateNotify:
         self.idle_timeout.idle_gcode = TemplateWrapper(self.printer, self.gcode_macro.env,
                                                   "idle_timeout:gcode", idle_gcode)
 
-        self.inactive_timer = self.reactor.register_timer(self._inactive_timer_handler,
-                                                      self.reactor.monotonic() + 
-                                                      self.inactive_timeout)
-        self.pause_timer = self.reactor.register_timer(self._print_pause_handler)
+        # The idle_timeout module only considers toolhead activity. In order
+        # to keep the printer active without running any GCode, extend the
+        # idle timeout check by the time since the last keepalive. Active
+        # heaters keep the printer active for as long as they are on.
+        check_idle_timeout = self.idle_timeout.check_idle_timeout
+
+        def _check_idle_timeout(eventtime):
+            if self.keepalive == "direct" and self.active_heaters and \
+                    self.state not in ("paused", "printing"):
+                self.keepalive_time = eventtime
+            remaining = self.keepalive_time + self.idle_timeout.idle_timeout - \
+                eventtime
+            if remaining > 0.:
+                return eventtime + remaining
+            return check_idle_timeout(eventtime)
+        self.idle_timeout.check_idle_timeout = _check_idle_timeout
+
+        self.inactive_timer = self.profiler.register_timer("state_notify:inactive",
+                                                           self._inactive_timer_handler,
+                                                           self.reactor.monotonic() +
+                                                           self.inactive_timeout)
+        self.pause_timer = self.profiler.register_timer("state_notify:pause",
+                                                        self._print_pause_handler)
+        self.dispatch_timer = self.profiler.register_timer("state_notify:dispatch",
+                                                           self._dispatch_handler)
         self.printer.register_event_handler("idle_timeout:idle",
                                         lambda e: self._state_handler("idle_idle", e))
         self.printer.register_event_handler("idle_timeout:ready",
@@ -91,7 +160,8 @@ class StateNotify:
             self.printer.register_event_handler("menu:exit",
                                         lambda e: self._state_handler("menu_exit",
                                                                       self.reactor.monotonic()))
-            self.menu_check_timer = self.reactor.register_timer(self._menu_check_timer_handler)
+            self.menu_check_timer = self.profiler.register_timer("state_notify:menu",
+                                                                 self._menu_check_timer_handler)
     
         self.printer.register_event_handler("klippy:ready",
                                             lambda: self._klippy_handler("ready"))
@@ -117,6 +187,9 @@ class StateNotify:
                 self.reactor.unregister_timer(self.menu_check_timer)
             if self.pause_timer:
                 self.reactor.unregister_timer(self.pause_timer)
+            if self.dispatch_timer:
+                self.reactor.unregister_timer(self.dispatch_timer)
+            self.template_queue.clear()
 
     def _check_printer_printing(self):
         # VirtualSD.is_active() only returns True if the printer is actively
@@ -131,12 +204,12 @@ class StateNotify:
         log(eventtime, "State: %s, Substate: %s", self.state, state)
         template = None
         if state == "idle_idle":
-            self.reactor.update_timer(self.pause_timer, self.reactor.NEVER)
-            self.reactor.update_timer(self.inactive_timer, self.reactor.NEVER)
+            self.profiler.update_timer(self.pause_timer, self.reactor.NEVER)
+            self.profiler.update_timer(self.inactive_timer, self.reactor.NEVER)
             state = "idle"
             if self.menu:
-                self.reactor.update_timer(self.menu_check_timer,
-                                          self.reactor.NEVER)
+                self.profiler.update_timer(self.menu_check_timer,
+                                            self.reactor.NEVER)
                 self.menu.exit()
         elif state in ("idle_ready", "menu_exit"):
             menu_is_running = False
@@ -144,25 +217,25 @@ class StateNotify:
                 menu_is_running = self.menu.is_running()
             if self.state in ("ready", "active", "printing"):
                 if self.state != "active":
-                    self.reactor.update_timer(self.pause_timer, self.reactor.NEVER)
+                    self.profiler.update_timer(self.pause_timer, self.reactor.NEVER)
                 if not menu_is_running:
-                    self.reactor.update_timer(self.inactive_timer,
-                                              self.reactor.monotonic() + self.inactive_timeout)
+                    self.profiler.update_timer(self.inactive_timer,
+                                                self.reactor.monotonic() + self.inactive_timeout)
             return
         elif state == "idle_printing" or state == "menu_begin":
-            self.reactor.update_timer(self.inactive_timer, self.reactor.NEVER)
+            self.profiler.update_timer(self.inactive_timer, self.reactor.NEVER)
             if state == "menu_begin":
-                self.reactor.update_timer(self.menu_check_timer,
-                                          self.reactor.monotonic() + TIMER_DURATION)
+                self.profiler.update_timer(self.menu_check_timer,
+                                            self.reactor.monotonic() + TIMER_DURATION)
             state = "active"
-            self.reactor.update_timer(self.pause_timer, self.reactor.NEVER)
+            self.profiler.update_timer(self.pause_timer, self.reactor.NEVER)
             if self._check_printer_printing():
                 state = "printing"
                 # There is no way for us to get a notification that the
                 # print has been paused other than to monitor the
                 # print_stats.
-                self.reactor.update_timer(self.pause_timer,
-                                          self.reactor.monotonic() + TIMER_DURATION)
+                self.profiler.update_timer(self.pause_timer,
+                                            self.reactor.monotonic() + TIMER_DURATION)
                 if self.state not in ("paused", "active"):
                     template = "active"
         if self.state != state and not self.ignore_change:
@@ -177,7 +250,7 @@ class StateNotify:
             self._state_handler("menu_exit", eventtime)
             return self.reactor.NEVER
         if self.state not in ("paused", "printing"):
-            self._run_template(eventtime, "noop")
+            self._keepalive(eventtime)
         return self.reactor.monotonic() + TIMER_DURATION
 
     # Timer to monitor print statistics for state changes. This is needed to catch
@@ -190,37 +263,102 @@ class StateNotify:
             return eventtime + TIMER_DURATION
         return self.reactor.NEVER
 
-    def _run_gcode(self, template):
-        try:
-            script = self.gcode_templates[template].render()
-            res = self.gcode.run_script(script)
-        except Exception as err:
-            logging.exception("state_notify: '%s' gcode error: %s" %
-                              (template, str(err)))
-            res = None
+    # Run the template while holding the gcode mutex. Waiting for the mutex
+    # is recorded separately from running the template so commands running
+    # at the time of the state transition are not blamed on the template.
+    def _run_gcode(self, template, transition=None, queued=None):
+        now = self.reactor.monotonic()
+        if queued is None:
+            queued = now
+        with self.gcode.get_mutex():
+            start = self.reactor.monotonic()
+            # The dispatch timer is paused while waiting for the mutex. Don't
+            # count the wait as reactor time used by the timer.
+            if self.dispatching:
+                self.profiler.exclude_time(self.dispatch_timer, start - now)
+            try:
+                script = self.gcode_templates[template].render()
+                res = self.gcode.run_script_from_command(script)
+            except Exception as err:
+                logging.exception("state_notify: '%s' gcode error: %s" %
+                                  (template, str(err)))
+                res = None
+            end = self.reactor.monotonic()
+        if transition is not None:
+            transition["template_wait"] = start - queued
+            transition["template_time"] = end - start
+            self._update_history_status()
         return res
 
-    def _delayed_gcode_handler(self, eventtime, template):
-        if self.gcode.get_mutex().test():
-            return eventtime + GCODE_MUTEX_DELAY
-        self._run_gcode(template)
-        try:
-            self.reactor.unregister_timer(self.delayed_gcode_timer)
-        except ValueError:
-            pass
+    # Run all queued templates in the order in which they were queued.
+    # _run_gcode() waits on the gcode mutex so each template runs as soon as
+    # the mutex is released.
+    def _dispatch_handler(self, eventtime):
+        self.dispatching = True
+        while self.template_queue:
+            self._run_gcode(*self.template_queue.popleft())
+        self.dispatching = False
         return self.reactor.NEVER
 
-    # Attempt to run the gcode template. If the gcode mutex is not taken, run the
-    # template directly. Otherwise, schedule a timer to run the gcode at a later
-    # time.
-    def _run_template(self, eventtime, template):
-        if not self.gcode.get_mutex().test():
-            return self._run_gcode(template)
-        self.delayed_gcode_timer = \
-            self.reactor.register_timer(lambda e: self._delayed_gcode_handler(e, template),
-                                        self.reactor.monotonic() + GCODE_MUTEX_DELAY)
+    # Attempt to run the gcode template. If the gcode mutex is not taken and
+    # there are no templates waiting, run the template directly. Otherwise,
+    # queue the template for the dispatch timer. Keepalive "noop" templates
+    # already waiting in the queue are not queued again.
+    def _run_template(self, eventtime, template, transition=None):
+        if not self.template_queue and not self.dispatching and \
+                not self.gcode.get_mutex().test():
+            return self._run_gcode(template, transition)
+        if template == "noop" and \
+                any(t[0] == template for t in self.template_queue):
+            return None
+        self.template_queue.append((template, transition,
+                                    self.reactor.monotonic()))
+        if not self.dispatching:
+            self.profiler.update_timer(self.dispatch_timer, self.reactor.NOW)
         return None
 
+    # Keep the printer active. By default, this is done by recording the
+    # keepalive time, which the idle_timeout check takes into account. This
+    # does not involve the gcode mutex or the toolhead. Once idle_timeout has
+    # reached its "Idle" state, only toolhead activity will move it out of it.
+    # In that case, or if configured to do so, run the "noop" template.
+    def _keepalive(self, eventtime):
+        if self.keepalive == "gcode" or self.idle_timeout.state == "Idle":
+            self._run_template(eventtime, "noop")
+            return
+        self.keepalive_time = eventtime
+
+    # Wrap the heater's set_temp() method so the set of heaters with a
+    # non-zero target is updated as targets change.
+    def _wrap_heater(self, heater_name, heater):
+        set_temp = heater.set_temp
+
+        def _set_temp(degrees):
+            set_temp(degrees)
+            self._heater_target_update(heater_name, degrees)
+        heater.set_temp = _set_temp
+
+    def _heater_target_update(self, heater_name, degrees):
+        was_active = bool(self.active_heaters)
+        if degrees > 0.:
+            self.active_heaters.add(heater_name)
+        else:
+            self.active_heaters.discard(heater_name)
+        if not was_active or self.active_heaters:
+            return
+        # The last active heater has been turned off. Activity can only
+        # change now so start the inactivity period from this point. With
+        # active heaters, the inactive timer is not running.
+        eventtime = self.reactor.monotonic()
+        log(eventtime, "All heaters off")
+        if self.keepalive == "direct" and \
+                self.state not in ("paused", "printing"):
+            self.keepalive_time = eventtime
+        if self.state == "active" and self.idle_timeout.state == "Ready" and \
+                not (self.menu and self.menu.is_running()):
+            self.profiler.update_timer(self.inactive_timer,
+                                        eventtime + self.inactive_timeout)
+
     # Check whether the printer is still active. This is used to detect
     # activity, which is not readily detectable from the idle_timeout
     # state.
@@ -230,25 +368,24 @@ class StateNotify:
     # If we want to keep the printer in the "active" state when
     # heaters are active, we need special handling.
     def _check_printer_active(self, eventtime):
-        heaters = self.pheaters.get_all_heaters()
-        heaters_active = False
-        for heater_name in heaters:
-            heater = self.pheaters.lookup_heater(heater_name)
-            status = heater.get_status(eventtime)
-            if status["target"] > 0.:
-                log(eventtime, f"Heater '{heater_name}' target: {status['target']}")
-                heaters_active = True
-                break
+        heaters_active = bool(self.active_heaters)
         if heaters_active and self.state not in ("paused", "printing"):
-            self._run_template(eventtime, "noop")
+            self._keepalive(eventtime)
         return heaters_active
 
     # Transition to the "inactive" state. This callback is called when the
     # inactive timeout elapses.
+    #
+    # With the direct keepalive, active heaters keep idle_timeout from timing
+    # out on their own and the timer is restarted once the last heater has
+    # been turned off. The "noop" template, on the other hand, has to be run
+    # periodically.
     def _inactive_timer_handler(self, eventtime):
         if self._check_printer_active(eventtime):
+            if self.keepalive == "direct":
+                return self.reactor.NEVER
             if self.heaters_keep_active:
-                self._run_template(eventtime, 'noop')
+                self._keepalive(eventtime)
             return eventtime + self.inactive_timeout
 
         self.ignore_change = True
@@ -258,6 +395,18 @@ class StateNotify:
 
     def handle_state_change(self, state, eventtime, template=None):
         log(eventtime, "changing state from %s to %s", self.state, state)
+        # Replace, rather than update, the status values so previously
+        # reported values are not modified.
+        if self.state_start is not None:
+            self.state_time = dict(self.state_time)
+            self.state_time[self.state] = self.state_time.get(self.state, 0.) + \
+                max(eventtime - self.state_start, 0.)
+        self.state_start = eventtime
+        transition = {'time': eventtime, 'from': self.state, 'to': state,
+                      'template': None, 'template_wait': None,
+                      'template_time': None}
+        self.history.append(transition)
+        self._update_history_status()
         self.state = state
         self.printer.send_event("state_notify:%s" % self.state)
         if template is None:
@@ -265,12 +414,26 @@ class StateNotify:
         if template in self.gcode_templates and \
                 self.gcode_templates[template]:
             log(eventtime, "  running template: %s", template)
-            return self._run_template(eventtime, template)
+            transition["template"] = template
+            return self._run_template(eventtime, template, transition)
         return None
 
+    def _update_history_status(self):
+        self.history_status = [dict(t) for t in self.history]
+
+    def _get_state_time(self, eventtime):
+        state_time = dict(self.state_time)
+        if self.state_start is not None:
+            state_time[self.state] = state_time.get(self.state, 0.) + \
+                max(eventtime - self.state_start, 0.)
+        return state_time
+
     def get_status(self, eventtime):
         return {'state': self.state,
                 'inactive_timeout': self.inactive_timeout,
+                'state_time': self.state_time,
+                'state_start': self.state_start,
+                'history': self.history_status,
                 }
 
     cmd_STATE_NOTIFY_STATE_help = "Get current printer status"
@@ -278,5 +441,25 @@ class StateNotify:
     def cmd_STATE_NOTIFY_STATE(self, gcmd):
         self.gcode.respond_info("State Notify state: %s" % self.state)
 
+    cmd_STATE_NOTIFY_HISTORY_help = "Show state transition history"
+
+    def cmd_STATE_NOTIFY_HISTORY(self, gcmd):
+        eventtime = self.reactor.monotonic()
+        msg = ["State Notify history:"]
+        for t in self.history:
+            line = "  %.1fs ago: %s -> %s" % (eventtime - t["time"], t["from"],
+                                              t["to"])
+            if t["template"] is not None:
+                if t["template_time"] is None:
+                    line += " (template: %s, pending)" % t["template"]
+                else:
+                    line += " (template: %s, %.3fs, waited %.3fs)" % \
+                        (t["template"], t["template_time"], t["template_wait"])
+            msg.append(line)
+        msg.append("Time in state:")
+        for state, secs in sorted(self._get_state_time(eventtime).items()):
+            msg.append("  %s: %.1fs" % (state, secs))
+        self.gcode.respond_info("\n".join(msg))
+
 def load_config(config):
     return StateNotify(config)
@@ -27,6 +27,8 @@ class TempTracker:
         if self.range_max == -1:
             self.range_max = float('inf')
         self.sensor = None
+        self.profiler = self.printer.load_object(config, "extensions_profile",
+                                                 None)
         self._data = []
         gcode = self.printer.lookup_object("gcode")
         gcode.register_mux_command("TEMP_TRACKER_GET", "TRACKER",
@@ -42,7 +44,12 @@ class TempTracker:
         self.sensor = self.printer.lookup_object("temperature_sensor " + self.sensor_name)
         reactor = self.printer.get_reactor()
         eventtime = reactor.monotonic()
-        self.tracker_timer = reactor.register_timer(self.tracker_track, eventtime + 1.)
+        if self.profiler is None:
+            self.tracker_timer = reactor.register_timer(self.tracker_track,
+                                                        eventtime + 1.)
+        else:
+            self.tracker_timer = self.profiler.register_timer(
+                "temp_tracker " + self.name, self.tracker_track, eventtime + 1.)
 
     def _klippy_shutdown(self):
         reactor = self.printer.get_reactor()